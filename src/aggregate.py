@@ -0,0 +1,241 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
+
+import numpy as np
+import pandas as pd
+
+import encoding
+import instrument
+import loader
+import paths
+import transitions
+import visits
+
+# Default number of events kept in each sunburst path
+MAX_DEPTH = 7
+
+# Bump when the layout of the summary changes, so saved summaries built by
+# older code are not merged with new ones
+SUMMARY_VERSION = 2
+
+# Dimensions the dashboard filters on: day of the visit start, referrer and
+# section. Visit-level counts (paths, transitions) use the visit's first hit.
+DIMENSIONS = ['day', 'referrer', 'simulated_subject']
+
+# Time zones the polar chart can show visit start hours in, and the levels
+# of the hours table below the dimensions
+TIMEZONES = [
+    'America/Toronto', 'America/Vancouver', 'America/Edmonton', 'America/Winnipeg',
+    'America/Halifax', 'America/St_Johns', 'UTC',
+]
+HOUR_LEVELS = ['timezone', 'weekday', 'hour']
+
+
+def dimensions(data):
+    # Filter dimensions of every hit: GMT day of the visit start, referrer
+    # and section
+    start = pd.to_datetime(data['visit_start_time_gmt'], utc=True).dt.tz_localize(None)
+    return pd.DataFrame({
+        'day': start.dt.normalize(),
+        'referrer': data['referrer'],
+        'simulated_subject': data['simulated_subject'],
+    })
+
+
+def local_hours(seconds, codes, journey):
+    # Visits and account creations by group code and by local weekday and
+    # hour of the start in every zone of TIMEZONES. Zone offsets are whole
+    # or half hours, so each GMT half hour has one local weekday and hour:
+    # the hits are counted once per (group, half hour) and the small result
+    # is spread over the zones.
+    slots, slot_codes = np.unique(seconds // 1800, return_inverse=True)
+    keys, inverse = np.unique(codes * len(slots) + slot_codes, return_inverse=True)
+    visits = np.bincount(inverse, minlength=len(keys))
+    conversions = np.bincount(inverse, weights=journey, minlength=len(keys)).astype('int64')
+    group, slot = keys // max(len(slots), 1), keys % max(len(slots), 1)
+
+    utc = pd.to_datetime(slots * 1800, unit='s', utc=True)
+    tables = []
+    for timezone in TIMEZONES:
+        local = utc.tz_convert(timezone)
+        tables.append(pd.DataFrame({
+            'group': group,
+            'timezone': timezone,
+            'weekday': local.dayofweek.to_numpy()[slot],
+            'hour': local.hour.to_numpy()[slot],
+            'visits': visits,
+            'conversions': conversions,
+        }))
+    return pd.concat(tables).groupby(['group'] + HOUR_LEVELS).sum()
+
+
+def group_codes(dims):
+    # Code of every hit's combination of dimensions, combined from the
+    # integer codes of each dimension, and the dimensions of each code
+    encoded = [encoding.encode(dims[name]) for name in DIMENSIONS]
+    key = np.zeros(len(dims), dtype='int64')
+    for codes, vocabulary in encoded:
+        # Missing values (-1) get their own slot
+        key = key * (len(vocabulary) + 1) + codes + 1
+    uniques, inverse = np.unique(key, return_inverse=True)
+
+    groups = {}
+    for name, (codes, vocabulary) in reversed(list(zip(DIMENSIONS, encoded))):
+        slots = uniques % (len(vocabulary) + 1) - 1
+        uniques = uniques // (len(vocabulary) + 1)
+        values = pd.Series(vocabulary).reindex(slots)
+        groups[name] = values.to_numpy(dtype=dims[name].dtype if name == 'day' else object)
+    return inverse, pd.DataFrame(groups, columns=DIMENSIONS)
+
+
+def with_dimensions(counts, groups):
+    # Replace the 'group' level of counts by the dimensions
+    codes = counts.index.codes[0]
+    group_codes = counts.index.levels[0][codes] if len(counts) else np.zeros(0, dtype='int64')
+    arrays = [groups[name].to_numpy()[group_codes] for name in DIMENSIONS]
+    arrays += [counts.index.get_level_values(level) for level in counts.index.names[1:]]
+    index = pd.MultiIndex.from_arrays(arrays, names=DIMENSIONS + counts.index.names[1:])
+    if isinstance(counts, pd.DataFrame):
+        return pd.DataFrame(counts.to_numpy(), index=index, columns=counts.columns, dtype='int64')
+    return pd.Series(counts.to_numpy(), index=index, dtype='int64')
+
+
+def summarize(data, max_depth=MAX_DEPTH, index=None):
+    # Counts broken down by DIMENSIONS, the cube rollup() slices. Paths and
+    # transitions share one visit index, built here unless one is given.
+    data = encoding.categorize(data)
+    # Every count is keyed by the group code of the hit's dimensions;
+    # visit-level counts use the dimensions of the visit's first hit
+    with instrument.span('summarize.keys', data) as span:
+        codes, groups = group_codes(dimensions(data))
+        span.set_rows_out(groups)
+
+    # Visits and account creations by local start hour (first pages only)
+    with instrument.span('summarize.hours', data) as span:
+        seconds = loader.epoch_seconds(data['visit_start_time_gmt'])
+        first_pages = (data['visit_page_num'] == 1).to_numpy() & (seconds != loader.MISSING_SECONDS)
+        journey = pd.to_numeric(data['Account_Created_journey'], errors='coerce').fillna(0).to_numpy()
+        hours = local_hours(seconds[first_pages], codes[first_pages], journey[first_pages])
+        hours = with_dimensions(hours, groups).sort_index()
+        span.set_rows_out(hours)
+
+    # Visit count for each referrer and section
+    hits = pd.Series(np.bincount(codes, minlength=len(groups)), index=pd.MultiIndex.from_frame(groups), dtype='int64')
+    referrer_subject = hits[groups.notna().all(axis=1).to_numpy()].sort_index()
+
+    with instrument.span('summarize.visits', data):
+        if index is None:
+            index = visits.build_index(data)
+
+    # Account-creating visits through each path prefix
+    with instrument.span('summarize.paths', data) as span:
+        prefix_counts = with_dimensions(paths.count_prefixes(data, max_depth, codes, index), groups)
+        span.set_rows_out(prefix_counts)
+
+    # Page-to-page transitions inside visits
+    with instrument.span('summarize.transitions', data) as span:
+        transition_counts = with_dimensions(transitions.count_transitions(data, codes, index), groups)
+        span.set_rows_out(transition_counts)
+
+    return {
+        'hours': hours,
+        'referrer_subject': referrer_subject,
+        'paths': prefix_counts,
+        'transitions': transition_counts,
+    }
+
+
+def select(counts, start=None, end=None, referrers=None, subjects=None):
+    # Rows of a summary entry inside the date range, referrers and sections
+    mask = np.ones(len(counts), dtype=bool)
+    if start:
+        mask &= counts.index.get_level_values('day') >= pd.Timestamp(start)
+    if end:
+        mask &= counts.index.get_level_values('day') <= pd.Timestamp(end)
+    if referrers:
+        mask &= counts.index.get_level_values('referrer').isin(referrers)
+    if subjects:
+        mask &= counts.index.get_level_values('simulated_subject').isin(subjects)
+    return counts[mask]
+
+
+def rollup(summary, start=None, end=None, referrers=None, subjects=None):
+    # Slice the cube and sum out the dimensions, giving the per-chart
+    # summaries the chart builders draw. 'event_subjects' is the traffic into
+    # each event by the section of the visit, which the network groups small
+    # nodes by.
+    filters = dict(start=start, end=end, referrers=referrers, subjects=subjects)
+    routes = select(summary['transitions'], **filters)
+    return {
+        'hours': select(summary['hours'], **filters).groupby(level=HOUR_LEVELS).sum(),
+        'referrer_subject': select(summary['referrer_subject'], **filters).groupby(
+            level=['referrer', 'simulated_subject']).sum(),
+        'paths': select(summary['paths'], **filters).groupby(level='path').sum(),
+        'transitions': routes.groupby(level=['source', 'target']).sum(),
+        'event_subjects': routes.groupby(level=['target', 'simulated_subject']).sum(),
+    }
+
+
+def merge_summaries(left, right):
+    # Every summary entry is a table of counts, so partial results add up
+    merged = {}
+    for name in left:
+        merged[name] = left[name].add(right[name], fill_value=0).astype('int64')
+    return merged
+
+
+def summarize_chunks(chunks, max_depth=MAX_DEPTH, index_writer=None):
+    # Fold each chunk into the running summary so memory stays bounded by
+    # the chunk size and the number of distinct keys. The visit index of
+    # every chunk is written out through index_writer when one is given.
+    summary = None
+    for part in visits.whole_visits(chunks):
+        index = visits.build_index(part)
+        if index_writer is not None:
+            visits.append_index(index_writer, index)
+        part = summarize(part, max_depth, index)
+        summary = part if summary is None else merge_summaries(summary, part)
+    return summary
+
+
+def partition_visits(data, partitions):
+    # Split the hits by a hash of the visit id so every visit's pages stay
+    # together in one partition
+    buckets = pd.util.hash_pandas_object(data['identifiant_visite'], index=False).values % partitions
+    return [part for _, part in data.groupby(buckets, sort=False)]
+
+
+def summarize_parallel(data, workers, max_depth=MAX_DEPTH):
+    # Summarize visit partitions in worker processes and add them up, which
+    # gives the same summary as the serial path
+    if workers <= 1:
+        return summarize(data, max_depth)
+    # The dashboard calls this from a build thread while others run, and a
+    # process forked from a threaded one can deadlock on a lock another
+    # thread held, so workers come from a forkserver instead
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+        parts = executor.map(partial(summarize, max_depth=max_depth), partition_visits(data, workers))
+        return reduce(merge_summaries, parts)
+
+
+def as_summary(data):
+    # Chart builders accept the hit table, a summary or an already rolled up
+    # summary
+    if not isinstance(data, dict):
+        data = summarize(data)
+    if 'day' in data['hours'].index.names:
+        data = rollup(data)
+    return data
+
+
+def filter_options(summary):
+    # Date bounds, referrers and sections offered by the dashboard filters
+    index = summary['hours'].index
+    days = index.get_level_values('day')
+    return {
+        'start': days.min().date() if len(days) else None,
+        'end': days.max().date() if len(days) else None,
+        'referrers': sorted(index.get_level_values('referrer').dropna().unique()),
+        'subjects': sorted(index.get_level_values('simulated_subject').dropna().unique()),
+    }
@@ -1,69 +1,359 @@
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import dash
-import pandas as pd
 from dash import Dash, dash_table, dcc, html, Input, Output, State
 import plotly.express as px
 import plotly.graph_objects as go
 import requests
 import csv
+from flask import send_from_directory
 
+import aggregate
+import figure_cache
+import ingest
+import instrument
+import loader
 import polar
 import bar_chart
 import sunburst
 import network
+import visits
+import funnel
+import funnel_chart
 
-app = Dash(__name__)
+# Responses are gzip or brotli compressed (flask-compress), which matters
+# most for the figures embedded in the layout
+app = Dash(__name__, compress=True)
 server = app.server
 app.title = 'Radio Canada Data Visualization Project | INF8808'
 
-dataframe = pd.read_csv('f:/RC50000.csv')
-#dataframe = pd.read_csv('./RC1000-1.csv')
+# vis.js and the other bundles used by the network page, served once
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+
+
+@server.route('/lib/<path:filename>')
+def serve_lib(filename):
+    return send_from_directory(LIB_DIR, filename, max_age=86400)
+
+
+# Stage timings on /metrics when RC_INSTRUMENT is set
+instrument.register(server)
+
+
+# Path of the clickstream export, e.g. RC_DATA_PATH=./RC1000-1.csv for the sample
+DATA_PATH = os.environ.get('RC_DATA_PATH', 'f:/RC50000.csv')
+# State directory filled by ingest.py from daily exports, used instead of
+# DATA_PATH when set
+STATE_DIR = os.environ.get('RC_STATE_DIR')
+# Rows per chunk when streaming the export, 0 loads it in one piece
+CHUNKSIZE = int(os.environ.get('RC_CHUNKSIZE', 0))
+# Worker processes used to aggregate a fully loaded export
+WORKERS = int(os.environ.get('RC_WORKERS', 1))
+# Number of events shown along each sunburst path
+SUNBURST_DEPTH = int(os.environ.get('RC_SUNBURST_DEPTH', aggregate.MAX_DEPTH))
+# Most nodes drawn in the network before quiet pages are grouped by section
+NETWORK_NODES = int(os.environ.get('RC_NETWORK_NODES', network.MAX_NODES))
+
+
+# Finished figures are cached on disk by data fingerprint and parameters, so
+# workers only read the data when the export changed
+FINGERPRINT = ingest.fingerprint(STATE_DIR) if STATE_DIR else loader.fingerprint(DATA_PATH)
+
+
+def build_summary():
+    # Aggregate the hits once and draw every chart from the shared summary
+    if STATE_DIR:
+        return ingest.load_summary(STATE_DIR)
+    if CHUNKSIZE:
+        # The funnel's visit index is written to disk chunk by chunk in the
+        # same pass, so neither the export nor the index is held in memory
+        directory = visits.index_directory(DATA_PATH)
+        writer = None
+        if not os.path.exists(directory):
+            os.makedirs(loader.CACHE_DIR, exist_ok=True)
+            writer = visits.open_index(directory)
+        summary = aggregate.summarize_chunks(loader.iter_chunks(DATA_PATH, CHUNKSIZE), SUNBURST_DEPTH, writer)
+        if writer is not None:
+            visits.close_index(writer)
+            loader.prune_cache(DATA_PATH)
+        return summary
+    data = loader.load_data(DATA_PATH)
+    if WORKERS > 1:
+        return aggregate.summarize_parallel(data, WORKERS, SUNBURST_DEPTH)
+    # The visit index is memory-mapped from the cache on later rebuilds
+    return aggregate.summarize(data, SUNBURST_DEPTH, visits.cached_index(DATA_PATH, data))
+
+
+def get_summary():
+    # The summary is a cube of counts by day, referrer and section that the
+    # filters slice, cached on disk next to the figures
+    return built('summary')
+
+
+@functools.lru_cache(maxsize=64)
+def filtered_summary(start, end, referrers, subjects):
+    # Recent filter combinations are kept so going back and forth is instant
+    with instrument.span('filters.rollup') as span:
+        summary = aggregate.rollup(get_summary(), start, end, referrers, subjects)
+        span.set_rows_out(summary)
+    return summary
+
+
+def build_funnel():
+    # The funnel engine works on individual hits through the visit index,
+    # which the incremental state does not keep
+    if STATE_DIR:
+        return None
+    # Wait for the summary, which saves the index when it reads the export.
+    # When the summary came from the cache and the index is missing, it is
+    # rebuilt the same way the summary reads the export: whole, or streamed
+    # in chunks when CHUNKSIZE is set.
+    built('summary')
+    return funnel.prepare(visits.cached_index(DATA_PATH, chunksize=CHUNKSIZE))
+
+
+# The summary, the filter options and every figure are built in background
+# threads, so the server answers as soon as it is up and each chart is
+# filled by its callback once its own figure is ready
+BUILDERS = {
+    'summary': lambda: figure_cache.load_or_build_pickle(
+        'summary', FINGERPRINT, {'depth': SUNBURST_DEPTH}, build_summary),
+    'filters': lambda: figure_cache.load_or_build_pickle(
+        'filters', FINGERPRINT, {'depth': SUNBURST_DEPTH},
+        lambda: aggregate.filter_options(get_summary())),
+    'polar': lambda: figure_cache.load_or_build(
+        'polar', FINGERPRINT, {'timezone': polar.TIMEZONE},
+        lambda: polar.generate_polar(get_summary())),
+    'bar': lambda: figure_cache.load_or_build(
+        'bar', FINGERPRINT, {},
+        lambda: bar_chart.generate_bar_chart(get_summary())),
+    'sunburst': lambda: figure_cache.load_or_build(
+        'sunburst', FINGERPRINT, {'depth': SUNBURST_DEPTH, 'min_share': sunburst.MIN_SHARE},
+        lambda: sunburst.generate_sunburst(get_summary())),
+    'network': lambda: figure_cache.load_or_build_html(
+        'network', FINGERPRINT, {'top_k': network.TOP_K, 'min_count': network.MIN_COUNT, 'max_nodes': NETWORK_NODES},
+        lambda: network.generate_network(get_summary(), max_nodes=NETWORK_NODES)),
+    'funnel': build_funnel,
+}
+_builds = {}
+_builds_pid = None
+_builds_lock = threading.Lock()
+_executor = None
+
+
+def start_builds():
+    # Threads do not survive a fork (gunicorn --preload), so each process
+    # starts its own builds the first time a result is needed
+    global _builds_pid, _executor
+    with _builds_lock:
+        if _builds_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=len(BUILDERS), thread_name_prefix='build')
+            _builds.clear()
+            _builds_pid = os.getpid()
+        # Failed builds are dropped from _builds, so they start again here
+        for name, build in BUILDERS.items():
+            if name not in _builds:
+                _builds[name] = _executor.submit(build)
+    return _builds
+
+
+def built(name):
+    # Wait for one result, started together with all the others
+    future = start_builds()[name]
+    try:
+        return future.result()
+    except Exception:
+        with _builds_lock:
+            if _builds.get(name) is future:
+                del _builds[name]
+        raise
 
-polar_fig = polar.generate_polar(dataframe)
-bar_fig = bar_chart.generate_bar_chart(dataframe)
-sunburst_fig = sunburst.generate_sunburst(dataframe)
-network_fig = network.generate_network(dataframe)
 
 app.layout = html.Div(
     children=[
         html.H1("Radio Canada Data Visualization", style={'text-align': 'center'}),
         html.H3("Our project is focused on visualizing the user journey to create an account on Radio Canada's platform, including the utilization of referral codes, visit times, and establishing connections. By analyzing and visualizing these aspects, we strive to improve user experience, optimize the account creation process, and identify key connections between user actions.", style={'text-align': 'center'}),
+        html.Div(
+            children=[
+                dcc.DatePickerRange(
+                    id='date-range',
+                    start_date_placeholder_text='Start date',
+                    end_date_placeholder_text='End date',
+                    clearable=True
+                ),
+                dcc.Dropdown(
+                    id='referrer-filter',
+                    multi=True,
+                    placeholder='All referrers',
+                    style={'width': '300px'}
+                ),
+                dcc.Dropdown(
+                    id='subject-filter',
+                    multi=True,
+                    placeholder='All sections',
+                    style={'width': '300px'}
+                ),
+            ],
+            style={'display': 'flex', 'justify-content': 'center', 'gap': '10px', 'text-align': 'left'}
+        ),
         html.H2("Polar Chart"),
-        dcc.Graph(
-            id='polar-chart',
-            figure=polar_fig
+        html.Div(
+            children=[
+                dcc.Dropdown(
+                    id='polar-timezone',
+                    options=aggregate.TIMEZONES,
+                    value=polar.TIMEZONE,
+                    clearable=False,
+                    style={'width': '300px'}
+                ),
+                dcc.Dropdown(
+                    id='polar-weekday',
+                    options=[{'label': name, 'value': i} for i, name in enumerate(polar.WEEKDAYS)],
+                    placeholder='All weekdays',
+                    style={'width': '300px'}
+                ),
+            ],
+            style={'display': 'flex', 'justify-content': 'center', 'gap': '10px', 'text-align': 'left'}
         ),
+        dcc.Loading(dcc.Graph(id='polar-chart'), type='circle'),
         html.H3("This polar chart provides unique insights into website visit distribution across time periods. The chart is divided into 24 sectors, representing one-hour intervals, and incorporates hue variations to indicate visit ratios. By examining the chart, we can identify peak times and high visitation rates.", style={'text-align': 'center'}),
         html.Br(),
 
         html.H2("Bar Chart"),
-        dcc.Graph(
-            id='bar-chart',
-            figure=bar_fig
-        ),
+        dcc.Loading(dcc.Graph(id='bar-chart'), type='circle'),
         html.H3("The bar chart here visually represents the correlation between referral sources and the likelihood of site visitors accessing specific areas. It features two axes: the horizontal axis displays various referral sources and on the vertical axis, the chart presents the number of visits to different sections of the Radio Canada website. This visualization helps us understand the impact of different referral sources on user engagement with specific areas of the site.", style={'text-align': 'center'}),
         html.Br(),
 
         html.H2("Sunburst Chart"),
-        dcc.Graph(
-            id='sunburst-chart',
-            figure=sunburst_fig
-        ),
+        dcc.Loading(dcc.Graph(id='sunburst-chart'), type='circle'),
         html.H3("The focus here is to understand the frequency of different user paths leading to account creation. To accomplish this, we have chosen a sunburst model as our primary visualization tool. The sunburst model provides a graphical representation of the user paths and includes a tooltip displaying the percentage of account creation and the specific user paths. This hierarchical representation helps enhance our understanding of the concept. The chart showcases the initial action at the center, followed by subsequent layers representing common actions leading to account creation, such as visiting specific website sections like sports and videos.", style={'text-align': 'center'}),
         html.Br(),
 
         html.H2("Network Chart"),
-        html.Iframe(
-            srcDoc=network_fig,
-            width='100%',
-            height='800px',
-            style={'border': 'none'}
+        dcc.Loading(
+            html.Iframe(
+                id='network-chart',
+                width='100%',
+                height='800px',
+                style={'border': 'none'}
+            ),
+            type='circle'
         ),
         html.H3("The network diagram here provides a concise representation of connections between different sections of the website. Nodes represent individual sections, while lines depict the paths between them. This diagram is useful for understanding complex systems, analyzing social networks, and visualizing information flow. In the context of the Canadian Radio website, the network diagram showcases interconnections among sections and visitation rates for each route. The chart helps identify popular paths and interactions between sections, especially in relation to account creation.", style={'text-align': 'center'}),
         html.Br(),
+
+        html.H2("Funnel Chart"),
+        html.Div(
+            children=[
+                dcc.Dropdown(
+                    id='funnel-steps',
+                    value=funnel_chart.DEFAULT_STEPS,
+                    multi=True,
+                    placeholder='Funnel steps, in order',
+                    style={'width': '600px'}
+                ),
+                dcc.Input(
+                    id='funnel-window',
+                    type='number',
+                    min=1,
+                    debounce=True,
+                    placeholder='Max minutes between steps'
+                ),
+            ],
+            style={'display': 'flex', 'justify-content': 'center', 'gap': '10px', 'text-align': 'left'}
+        ),
+        dcc.Loading(dcc.Graph(id='funnel-chart'), type='circle'),
+        html.H3("The funnel follows visits through an ordered list of steps, such as a home page, a section page and the account creation. Each bar counts the visits that reached a step after the previous ones, optionally within a limited time between two steps, which shows where visitors drop off on the way to creating an account.", style={'text-align': 'center'}),
+        html.Br(),
     ],
     style={'text-align': 'center'}
 )
 
+# Every chart listens to the same filters
+FILTERS = [
+    Input('date-range', 'start_date'),
+    Input('date-range', 'end_date'),
+    Input('referrer-filter', 'value'),
+    Input('subject-filter', 'value'),
+]
+
+
+@app.callback(
+    Output('date-range', 'min_date_allowed'),
+    Output('date-range', 'max_date_allowed'),
+    Output('referrer-filter', 'options'),
+    Output('subject-filter', 'options'),
+    Input('date-range', 'id'),
+)
+def fill_filters(_):
+    options = built('filters')
+    return options['start'], options['end'], options['referrers'], options['subjects']
+
+
+def filtered(start, end, referrers, subjects):
+    # Summary for the current filters, None when nothing is filtered so the
+    # precomputed figures can be served as they are
+    if not (start or end or referrers or subjects):
+        return None
+    return filtered_summary(start, end, tuple(referrers or ()), tuple(subjects or ()))
+
+
+@app.callback(Output('polar-chart', 'figure'), *FILTERS,
+              Input('polar-timezone', 'value'), Input('polar-weekday', 'value'))
+def update_polar(start, end, referrers, subjects, timezone, weekday):
+    # Every zone and weekday is in the summary, so switching views only
+    # slices it
+    summary = filtered(start, end, referrers, subjects)
+    if summary is None:
+        if timezone == polar.TIMEZONE and weekday is None:
+            return built('polar')
+        summary = filtered_summary(None, None, (), ())
+    with instrument.span('polar.update', summary):
+        return figure_cache.slim(polar.generate_polar(summary, timezone, weekday))
+
+
+@app.callback(Output('bar-chart', 'figure'), *FILTERS)
+def update_bar(start, end, referrers, subjects):
+    summary = filtered(start, end, referrers, subjects)
+    if summary is None:
+        return built('bar')
+    with instrument.span('bar.update', summary):
+        return figure_cache.slim(bar_chart.generate_bar_chart(summary))
+
+
+@app.callback(Output('sunburst-chart', 'figure'), *FILTERS)
+def update_sunburst(start, end, referrers, subjects):
+    summary = filtered(start, end, referrers, subjects)
+    if summary is None:
+        return built('sunburst')
+    with instrument.span('sunburst.update', summary):
+        return figure_cache.slim(sunburst.generate_sunburst(summary))
+
+
+@app.callback(Output('network-chart', 'srcDoc'), *FILTERS)
+def update_network(start, end, referrers, subjects):
+    summary = filtered(start, end, referrers, subjects)
+    if summary is None:
+        return built('network')
+    with instrument.span('network.update', summary):
+        return network.generate_network(summary, max_nodes=NETWORK_NODES)
+
+
+@app.callback(Output('funnel-steps', 'options'), Input('funnel-steps', 'id'))
+def fill_funnel_steps(_):
+    engine = built('funnel')
+    return [] if engine is None else sorted(engine['codes'])
+
+
+@app.callback(Output('funnel-chart', 'figure'), Input('funnel-steps', 'value'), Input('funnel-window', 'value'))
+def update_funnel(steps, window):
+    engine = built('funnel')
+    if engine is None or not steps:
+        return go.Figure(layout=dict(template='plotly_white', title='Choose the steps of the funnel' if engine else 'The funnel needs RC_DATA_PATH'))
+    return figure_cache.slim(funnel_chart.generate_funnel_chart(engine, steps, window))
 
 
 if __name__ == "__main__":
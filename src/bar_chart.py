@@ -2,15 +2,14 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 
-def generate_bar_chart(data):
-    # Drop rows with missing values in 'referrer' and 'simulated_subject' columns
-    filtered_data = data.dropna(subset=['referrer', 'simulated_subject'])
-
-    # Group data by 'referrer' and 'simulated_subject' and calculate the visit count
-    page_counts = filtered_data.groupby(['referrer', 'simulated_subject']).size().reset_index(name='visit_count')
+import aggregate
+import instrument
 
-    # Remove rows with missing values in the 'simulated_subject' column
-    page_counts = page_counts[~page_counts['simulated_subject'].isna()]
+def generate_bar_chart(data):
+    # Visit count per referrer and section, missing values already dropped
+    with instrument.span('bar.aggregate', data) as span:
+        page_counts = aggregate.as_summary(data)['referrer_subject'].reset_index(name='visit_count')
+        span.set_rows_out(page_counts)
 
     # Define a color palette for the bar chart
     colors = ['rgb(247,251,255)', 'rgb(222,235,247)', 'rgb(198,219,239)', 'rgb(158,202,225)', 'rgb(107,174,214)', 'rgb(66,146,198)', 'rgb(33,113,181)', 'rgb(8,81,156)', 'rgb(8,48,107)']
@@ -43,6 +42,10 @@ def generate_bar_chart(data):
         legend_title='Sections'
     )
 
+    # Nothing to highlight when the filters leave no bars
+    if not fig.data:
+        return fig
+
     clicked_charts = []
 
     def update_colors(clicked_subject):
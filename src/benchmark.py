@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import loader
+import aggregate
+import polar
+import bar_chart
+import sunburst
+import network
+import synthetic
+
+SCALES = [1000, 50000, 1000000, 10000000]
+DATA_DIR = os.path.join(loader.CACHE_DIR, 'synthetic')
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Imports app.py in a fresh interpreter and waits for every figure, so the
+# measurement includes module imports, loading and building the charts
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+cpu = time.process_time()
+import app
+ready = time.perf_counter()
+for name in app.BUILDERS:
+    app.built(name)
+print(json.dumps({
+    'import_seconds': ready - start,
+    'seconds': time.perf_counter() - start,
+    'cpu_seconds': time.process_time() - cpu,
+    'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def dataset(hits):
+    # Synthetic exports are generated once per scale and kept for later runs
+    path = os.path.join(DATA_DIR, 'synthetic-{}.csv'.format(hits))
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        synthetic.write_clickstream(path, hits)
+    return path
+
+
+def measure(function, *args):
+    # Wall and CPU time of one call, then the peak traced allocation of a
+    # second call, since tracing slows the code down
+    start = time.perf_counter()
+    cpu = time.process_time()
+    result = function(*args)
+    timing = {
+        'seconds': time.perf_counter() - start,
+        'cpu_seconds': time.process_time() - cpu,
+    }
+
+    tracemalloc.start()
+    function(*args)
+    timing['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, timing
+
+
+def measure_startup(path):
+    # Cold start of the dashboard with an empty cache directory
+    cache_dir = os.path.join(DATA_DIR, 'startup-cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    env = dict(os.environ, RC_DATA_PATH=path, RC_CACHE_DIR=cache_dir)
+    output = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT], cwd=SRC_DIR, env=env,
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def build_uncached(builder, data):
+    # The network page cache would turn repeated calls into a lookup
+    network._html_cache.clear()
+    return builder(data)
+
+
+def run(hits, startup=True):
+    path = dataset(hits)
+    results = {}
+    data, results['load'] = measure(loader.read_csv, path)
+    _, results['summarize'] = measure(aggregate.summarize, data)
+
+    # Each builder end to end from the hit table, as app.py used to call them
+    for name, builder in [('polar', polar.generate_polar), ('bar_chart', bar_chart.generate_bar_chart),
+                          ('sunburst', sunburst.generate_sunburst), ('network', network.generate_network)]:
+        _, results[name] = measure(build_uncached, builder, data)
+
+    if startup:
+        results['app_startup'] = measure_startup(path)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    # Print the time ratio of every stage against an earlier result file
+    for hits, stages in current['results'].items():
+        for stage, timing in stages.items():
+            before = previous['results'].get(hits, {}).get(stage)
+            if before:
+                ratio = timing['seconds'] / before['seconds']
+                print('{:>10} {:<12} {:8.3f}s  x{:.2f}'.format(hits, stage, timing['seconds'], ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time and memory-profile the chart builders')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier benchmark JSON to compare against')
+    parser.add_argument('--no-startup', action='store_true', help='skip the app.py cold start')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {},
+    }
+    for hits in args.scales:
+        report['results'][str(hits)] = run(hits, startup=not args.no_startup)
+        for stage, timing in report['results'][str(hits)].items():
+            print('{:>10} {:<12} {:8.3f}s {:9.1f} MB'.format(hits, stage, timing['seconds'], timing['peak_mb']))
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Columns held as dense integer codes plus a vocabulary. The loader reads
+# them as pandas categoricals, which are exactly that.
+CATEGORICAL = ['identifiant_visite', 'referrer', 'simulated_detailed_event', 'simulated_subject']
+
+
+def encode(values, missing=None):
+    # Integer code of every value and the vocabulary decoding them. Missing
+    # values get the code of the missing label when one is given, else -1.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy().astype('int64')
+        vocabulary = values.cat.categories.to_numpy(dtype=object)
+    else:
+        codes, vocabulary = pd.factorize(values)
+        vocabulary = np.asarray(vocabulary, dtype=object)
+
+    if missing is not None and (codes < 0).any():
+        found = np.flatnonzero(vocabulary == missing)
+        if len(found):
+            code = found[0]
+        else:
+            code = len(vocabulary)
+            vocabulary = np.append(vocabulary, missing)
+        codes = np.where(codes < 0, code, codes)
+    return codes, vocabulary
+
+
+def categorize(data):
+    # Encode the categorical columns of a frame that still holds strings,
+    # e.g. a raw CSV read without the loader
+    for name in CATEGORICAL:
+        if name in data and not isinstance(data[name].dtype, pd.CategoricalDtype):
+            data = data.assign(**{name: data[name].astype('category')})
+    return data
+
+
+def concat(frames):
+    # Concatenate frames whose categorical columns have different
+    # vocabularies, merging the vocabularies instead of falling back to
+    # strings like pd.concat does
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    data = pd.concat(frames, ignore_index=True)
+    for name in CATEGORICAL:
+        columns = [frame[name] for frame in frames if name in frame]
+        if len(columns) > 1 and all(isinstance(column.dtype, pd.CategoricalDtype) for column in columns):
+            data[name] = union_categoricals(columns, ignore_order=True)
+    return data
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import plotly.io as pio
+import plotly.offline
+
+import aggregate
+import figure_cache
+import loader
+import polar
+import bar_chart
+import sunburst
+import network
+import transitions
+
+# vis.js bundle used by the network page
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+PARTITIONS = ['month', 'referrer', 'subject']
+TITLE = 'Radio Canada Data Visualization'
+
+CHARTS = {
+    'polar': polar.generate_polar,
+    'bar': bar_chart.generate_bar_chart,
+    'sunburst': sunburst.generate_sunburst,
+}
+
+
+def slices(summary, partition_by):
+    # (name, filters) of every dashboard to write: the whole export, and one
+    # per month, referrer or section when partitioning
+    found = [('all', {})]
+    options = aggregate.filter_options(summary)
+    if partition_by == 'month' and options['start']:
+        for month in pd.period_range(options['start'], options['end'], freq='M'):
+            found.append(('month={}'.format(month), {
+                'start': str(month.start_time.date()),
+                'end': str(month.end_time.date()),
+            }))
+    elif partition_by == 'referrer':
+        found += [('referrer={}'.format(value), {'referrers': [value]}) for value in options['referrers']]
+    elif partition_by == 'subject':
+        found += [('subject={}'.format(value), {'subjects': [value]}) for value in options['subjects']]
+    return found
+
+
+def directory_name(name):
+    return name.replace('/', '-').replace(' ', '_')
+
+
+def render(chart, summary, directory):
+    # Build one chart of one slice and write its page and data. Runs in a
+    # worker process, so it only gets the small rolled-up summary.
+    if chart == 'network':
+        # The page loads vis.js from the lib/ copy at the top of the output
+        content = network.generate_network(summary).replace('/lib/', '../lib/')
+        with open(os.path.join(directory, 'network.html'), 'w', encoding='utf-8') as file:
+            file.write(content)
+        edges = transitions.top_edges(summary['transitions'], network.TOP_K, network.MIN_COUNT)
+        edges = network.collapse(edges, summary['event_subjects'], network.MAX_NODES)[0]
+        with open(os.path.join(directory, 'network.json'), 'w', encoding='utf-8') as file:
+            file.write(edges.to_json(orient='records'))
+        return chart
+
+    figure = figure_cache.slim(CHARTS[chart](summary))
+    with open(os.path.join(directory, chart + '.json'), 'w', encoding='utf-8') as file:
+        json.dump(figure, file, separators=(',', ':'))
+    # Pages share one plotly.js written at the top of the output
+    pio.write_html(figure, os.path.join(directory, chart + '.html'), include_plotlyjs='../plotly.min.js',
+                   full_html=True, validate=False)
+    return chart
+
+
+def write_index(path, title, links):
+    items = ''.join('<li><a href="{}">{}</a></li>'.format(href, label) for href, label in links)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('<html><head><meta charset="utf-8"><title>{0}</title></head>'
+                   '<body><h1>{0}</h1><ul>{1}</ul></body></html>'.format(title, items))
+
+
+def export(path, output, partition_by=None, workers=None, depth=aggregate.MAX_DEPTH):
+    summary = aggregate.summarize_parallel(loader.load_data(path), workers or 1, depth)
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'plotly.min.js'), 'w', encoding='utf-8') as file:
+        file.write(plotly.offline.get_plotlyjs())
+    shutil.copytree(LIB_DIR, os.path.join(output, 'lib'), dirs_exist_ok=True)
+
+    # Every chart of every slice is an independent job
+    jobs = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for name, filters in slices(summary, partition_by):
+            directory = os.path.join(output, directory_name(name))
+            os.makedirs(directory, exist_ok=True)
+            sliced = aggregate.rollup(summary, **filters)
+            for chart in list(CHARTS) + ['network']:
+                jobs.append(executor.submit(render, chart, sliced, directory))
+            write_index(os.path.join(directory, 'index.html'), '{} - {}'.format(TITLE, name),
+                        [(chart + '.html', chart) for chart in list(CHARTS) + ['network']])
+        for job in jobs:
+            job.result()
+
+    names = [name for name, _ in slices(summary, partition_by)]
+    write_index(os.path.join(output, 'index.html'), TITLE,
+                [(directory_name(name) + '/index.html', name) for name in names])
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write the dashboard charts as static HTML and JSON')
+    parser.add_argument('path', help='CSV or Parquet export')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--partition-by', choices=PARTITIONS, help='also write one dashboard per slice')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--depth', type=int, default=aggregate.MAX_DEPTH, help='events kept along each path')
+    args = parser.parse_args()
+    for name in export(args.path, args.output, args.partition_by, args.workers, args.depth):
+        print(name)
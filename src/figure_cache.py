@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import pickle
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no lock, workers may build the same entry concurrently
+    fcntl = None
+
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
+
+import instrument
+import loader
+
+# Bump when the chart code changes so figures built by older code are ignored
+VERSION = 4
+CACHE_DIR = os.path.join(loader.CACHE_DIR, 'figures')
+
+# Decimals kept in numeric arrays; the charts display at most two
+DECIMALS = 3
+
+# Plotly imports its JSON engine (orjson when installed) on first use, which
+# is not thread-safe: serialize one figure now, before the build threads
+# start, so they all find it imported
+pio.to_json(go.Figure())
+
+
+def cache_key(name, fingerprint, params):
+    # A figure is identified by the chart, the source data and its parameters
+    key = json.dumps([VERSION, name, fingerprint, params], sort_keys=True)
+    return '{}-{}'.format(name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+def round_arrays(node):
+    # Round the float arrays of a trace in place, and write arrays of whole
+    # numbers as integers, which drops the ".0" of every value
+    for key, value in node.items():
+        if isinstance(value, dict):
+            round_arrays(value)
+        elif isinstance(value, list) and value and all(type(v) in (int, float) for v in value):
+            array = np.round(np.asarray(value, dtype='float64'), DECIMALS)
+            if np.all(array == np.floor(array)):
+                node[key] = array.astype('int64').tolist()
+            else:
+                node[key] = array.tolist()
+
+
+def slim(figure):
+    # Plain JSON dict of a figure with its data at display precision, ready
+    # to be embedded in the page or returned by a callback
+    figure = json.loads(pio.to_json(figure))
+    for trace in figure.get('data', []):
+        round_arrays(trace)
+    return figure
+
+
+def write_atomic(path, content):
+    # Concurrent workers either see the complete file or no file at all
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as file:
+        file.write(content)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def build_lock(path):
+    # Exclusive lock on a cache entry across processes and threads, so that
+    # on a cold cache one gunicorn worker builds it while the others wait
+    # and then read the file it wrote
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path + '.lock', 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def load_or_build(name, fingerprint, params, build):
+    # Plotly figures are stored as JSON and returned as plain dicts, which
+    # dcc.Graph accepts without validating the figure again
+    path = os.path.join(CACHE_DIR, cache_key(name, fingerprint, params) + '.json')
+    with build_lock(path):
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                return json.load(file)
+
+        with instrument.span('{}.build'.format(name)):
+            figure = build()
+        with instrument.span('{}.serialize'.format(name)):
+            figure = slim(figure)
+            content = json.dumps(figure, separators=(',', ':'))
+        write_atomic(path, content)
+    return figure
+
+
+def load_or_build_html(name, fingerprint, params, build):
+    path = os.path.join(CACHE_DIR, cache_key(name, fingerprint, params) + '.html')
+    with build_lock(path):
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                return file.read()
+
+        with instrument.span('{}.build'.format(name)):
+            content = build()
+        write_atomic(path, content)
+    return content
+
+
+def load_or_build_pickle(name, fingerprint, params, build):
+    # Intermediate results such as the aggregated cube
+    path = os.path.join(CACHE_DIR, cache_key(name, fingerprint, params) + '.pkl')
+    with build_lock(path):
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+
+        with instrument.span('{}.build'.format(name)):
+            value = build()
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    return value
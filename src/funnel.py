@@ -0,0 +1,58 @@
+import numpy as np
+
+import loader
+import visits
+
+
+def prepare(index):
+    # Hits grouped by event code, in index order within each event, so a
+    # funnel step only reads the hits of its own event. A saved index holds
+    # these arrays already, memory-mapped.
+    if 'by_event' not in index:
+        index = dict(index, **visits.event_order(index))
+    return {
+        'index': index,
+        'codes': {label: code for code, label in enumerate(index['vocabulary'])},
+        'hit_visits': index['hit_visits'],
+        'by_event': index['by_event'],
+        'bounds': index['bounds'],
+    }
+
+
+def count_funnel(engine, steps, window=None):
+    # Number of visits reaching each step in order: a visit reaches step k
+    # when one of its hits has the step's event after a hit that reached
+    # step k - 1, and with a window (in seconds) at most that long after it
+    index = engine['index']
+    hit_visits = engine['hit_visits']
+    times = index['times']
+    reached = None
+    counts = []
+    for step in steps:
+        code = engine['codes'].get(step)
+        if code is None:
+            hits = np.zeros(0, dtype='int64')
+        else:
+            hits = engine['by_event'][engine['bounds'][code]:engine['bounds'][code + 1]]
+
+        if reached is not None and not len(reached):
+            hits = hits[:0]
+        elif reached is not None:
+            # Latest hit of the previous step before each candidate; hits
+            # are positions in index order, where a visit's hits are
+            # contiguous and sorted by page
+            before = np.searchsorted(reached, hits) - 1
+            previous = reached[np.maximum(before, 0)]
+            ok = (before >= 0) & (hit_visits[previous] == hit_visits[hits])
+            if window is not None:
+                # Hits without a time cannot be shown to be within the window
+                hit_times, previous_times = times[hits], times[previous]
+                ok &= (hit_times != loader.MISSING_SECONDS) & (previous_times != loader.MISSING_SECONDS)
+                ok &= hit_times - np.where(ok, previous_times, 0) <= window
+            hits = hits[ok]
+
+        # Hits stay in index order, so each visit's hits are adjacent
+        reached = hits
+        reached_visits = hit_visits[hits]
+        counts.append(int(np.count_nonzero(reached_visits[1:] != reached_visits[:-1])) + 1 if len(hits) else 0)
+    return counts
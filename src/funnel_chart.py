@@ -0,0 +1,41 @@
+import plotly.graph_objects as go
+
+import funnel
+import instrument
+
+# Steps shown before the user edits the funnel
+DEFAULT_STEPS = ['Page_accueil_Mordu', 'Page_Mordu', 'Action_creation_compte']
+
+
+def generate_funnel_chart(engine, steps, window_minutes=None):
+    # Visits reaching each step, with the drop-off from the previous step
+    # in the hover text
+    window = window_minutes * 60 if window_minutes else None
+    with instrument.span('funnel.count', len(engine['index']['events'])):
+        counts = funnel.count_funnel(engine, steps, window)
+    drop_off = [0] + [before - after for before, after in zip(counts, counts[1:])]
+
+    fig = go.Figure(go.Funnel(
+        y=['{}. {}'.format(i + 1, step) for i, step in enumerate(steps)],
+        x=counts,
+        customdata=drop_off,
+        textinfo='value+percent initial+percent previous',
+        marker=dict(color='rgb(66,146,198)'),
+        connector=dict(fillcolor='rgb(198,219,239)'),
+        hovertemplate='%{y}<br>Visits: %{x}<br>Lost since the previous step: %{customdata}<extra></extra>',
+    ))
+
+    # Update the layout of the chart
+    fig.update_layout(
+        title={
+            'text': 'Visits reaching each step of the journey' + (
+                ' (at most {} min between steps)'.format(window_minutes) if window_minutes else ''),
+            'x': 0.5,
+            'xanchor': 'center'
+        },
+        width=1000,
+        height=150 + 80 * max(len(steps), 1),
+        margin=dict(l=250, r=50, t=80, b=50),
+        template='plotly_white'
+    )
+    return fig
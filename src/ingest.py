@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+
+import aggregate
+import encoding
+import instrument
+import loader
+
+# Default location of the incremental state
+STATE_DIR = os.path.join(loader.CACHE_DIR, 'state')
+# A visit with no hit in the last INACTIVITY before the end of the newest
+# file is closed; more recent visits may continue in the next daily file
+INACTIVITY = pd.Timedelta(minutes=30)
+
+
+def state_path(state_dir):
+    return os.path.join(state_dir, 'state.pkl')
+
+
+def empty_state(max_depth):
+    return {'version': aggregate.SUMMARY_VERSION, 'files': [], 'depth': max_depth, 'summary': None, 'pending': None}
+
+
+def load_state(state_dir, max_depth=aggregate.MAX_DEPTH):
+    path = state_path(state_dir)
+    if not os.path.exists(path):
+        return empty_state(max_depth)
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def save_state(state_dir, state):
+    # Summary, pending hits and the file list are written together, so a
+    # failed ingest leaves the previous state untouched
+    os.makedirs(state_dir, exist_ok=True)
+    path = state_path(state_dir)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def fingerprint(state_dir):
+    # Changes whenever a file is ingested, so cached figures are rebuilt
+    state = load_state(state_dir)
+    key = '|'.join([str(state.get('version')), str(state['depth'])] + state['files'])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def fold(summary, data, max_depth):
+    # Add the summary of the given hits to the running summary
+    if not len(data):
+        return summary
+    part = aggregate.summarize(data, max_depth)
+    return part if summary is None else aggregate.merge_summaries(summary, part)
+
+
+def split_open_visits(data):
+    # Hits of the visits that were still active at the end of the data, and
+    # hits of the visits that are over
+    hit_time = pd.to_datetime(data['post_cust_hit_time_gmt'], utc=True)
+    visits = encoding.encode(data['identifiant_visite'])[0]
+    last_hit = hit_time.groupby(visits, sort=False).transform('max')
+    active = (last_hit >= hit_time.max() - INACTIVITY).to_numpy()
+    return data[active], data[~active]
+
+
+def ingest(state_dir, path, flush=False, max_depth=aggregate.MAX_DEPTH):
+    # Fold one new export into the state. Hits of visits still open at its
+    # end are held back until a later file closes them, or until flush.
+    state = load_state(state_dir, max_depth)
+    if state.get('version') != aggregate.SUMMARY_VERSION:
+        raise ValueError('state in {} was built by an older version, ingest the files again'.format(state_dir))
+    if state['depth'] != max_depth:
+        raise ValueError('state was built with depth {}, not {}'.format(state['depth'], max_depth))
+    key = loader.fingerprint(path)
+    if key in state['files']:
+        return False
+
+    with instrument.span('ingest.load') as span:
+        data = loader.read_csv(path)
+        span.set_rows_out(data)
+    if state['pending'] is not None:
+        data = encoding.concat([state['pending'], data])
+
+    if flush:
+        pending, closed = data.iloc[:0], data
+    else:
+        pending, closed = split_open_visits(data)
+    with instrument.span('ingest.summarize', closed):
+        state['summary'] = fold(state['summary'], closed, max_depth)
+    state['pending'] = pending.reset_index(drop=True)
+    state['files'].append(key)
+    save_state(state_dir, state)
+    return True
+
+
+def load_summary(state_dir):
+    # Summary of every ingested hit, counting the visits still pending as
+    # they are so far
+    state = load_state(state_dir)
+    pending = state['pending'] if state['pending'] is not None else pd.DataFrame()
+    summary = fold(state['summary'], pending, state['depth'])
+    if summary is None:
+        raise ValueError('no data ingested in {}'.format(state_dir))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fold daily clickstream exports into the dashboard state')
+    parser.add_argument('paths', nargs='+', help='exports to add, oldest first')
+    parser.add_argument('--state', default=STATE_DIR, help='state directory (RC_STATE_DIR for app.py)')
+    parser.add_argument('--depth', type=int, default=aggregate.MAX_DEPTH, help='events kept along each path')
+    parser.add_argument('--flush', action='store_true', help='close every pending visit after the last file')
+    args = parser.parse_args()
+
+    for i, path in enumerate(args.paths):
+        flush = args.flush and i == len(args.paths) - 1
+        if not ingest(args.state, path, flush, args.depth):
+            print('{} already ingested'.format(path))
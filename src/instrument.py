@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# RC_INSTRUMENT=1 records timings, RC_INSTRUMENT=memory also traces Python
+# allocations, which is slower. Anything else leaves spans as no-ops.
+MODE = os.environ.get('RC_INSTRUMENT', '')
+ENABLED = MODE in ('1', 'memory')
+
+logger = logging.getLogger('radiocanada.spans')
+
+# Most recent spans, and running totals per span name for /metrics
+recent = deque(maxlen=500)
+totals = {}
+_lock = threading.Lock()
+
+# tracemalloc keeps one peak for the whole process, so only a span opened
+# while no other is open measures it. Spans nested in it in the same thread
+# are part of its work; a span opened meanwhile in another thread makes its
+# peak unattributable, and it is not reported.
+_open_spans = 0
+_tracer = None
+
+if ENABLED and not logger.handlers:
+    # One JSON object per line on stderr, next to the server's own logs
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+if MODE == 'memory':
+    tracemalloc.start()
+
+
+class Span:
+    # Wall time, CPU time, peak RSS growth, traced allocation peak (outermost
+    # spans only) and row counts of one named stage
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = count_rows(rows_in)
+        self.rows_out = None
+
+    def set_rows_out(self, rows):
+        self.rows_out = count_rows(rows)
+
+    def __enter__(self):
+        global _open_spans, _tracer
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.thread = threading.get_ident()
+        self.shared = False
+        with _lock:
+            if _tracer is not None and _tracer.thread != self.thread:
+                _tracer.shared = True
+            if tracemalloc.is_tracing() and not _open_spans:
+                _tracer = self
+                self.traced = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            _open_spans += 1
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _open_spans, _tracer
+        record = {
+            'span': self.name,
+            'seconds': time.perf_counter() - self.start,
+            'cpu_seconds': time.process_time() - self.cpu,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self.rss) / 1024,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'pid': os.getpid(),
+        }
+        with _lock:
+            _open_spans -= 1
+            if _tracer is self:
+                _tracer = None
+                if not self.shared and tracemalloc.is_tracing():
+                    record['traced_peak_mb'] = (tracemalloc.get_traced_memory()[1] - self.traced) / 2 ** 20
+        record_span(record)
+        return False
+
+
+class NullSpan:
+    # Stand-in used when instrumentation is off
+    def set_rows_out(self, rows):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def count_rows(value):
+    # Rows of a frame or of every entry of a summary, or a count as is
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, dict):
+        return sum(len(entry) for entry in value.values())
+    return len(value)
+
+
+def span(name, rows_in=None):
+    return Span(name, rows_in) if ENABLED else NULL_SPAN
+
+
+def record_span(record):
+    with _lock:
+        recent.append(record)
+        total = totals.setdefault(record['span'], {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'rows_in': 0})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        total['rows_in'] += record['rows_in'] or 0
+    logger.info(json.dumps(record))
+
+
+def metrics_text():
+    # Totals in the Prometheus text format
+    lines = []
+    with _lock:
+        for metric, key in [('rc_span_count', 'count'), ('rc_span_seconds_total', 'seconds'),
+                            ('rc_span_cpu_seconds_total', 'cpu_seconds'), ('rc_span_rows_in_total', 'rows_in')]:
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, total in sorted(totals.items()):
+                lines.append('{}{{span="{}"}} {}'.format(metric, name, total[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def register(server):
+    # Expose /metrics and /metrics/spans on the Flask server when enabled
+    if not ENABLED:
+        return
+
+    @server.route('/metrics')
+    def metrics():
+        return metrics_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    @server.route('/metrics/spans')
+    def metrics_spans():
+        with _lock:
+            return json.dumps(list(recent)), 200, {'Content-Type': 'application/json'}
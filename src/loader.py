@@ -0,0 +1,166 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+import instrument
+
+# Columns read by the charts and the dtype each one is stored with
+COLUMNS = {
+    'identifiant_visite': 'category',
+    'visit_page_num': 'int16',
+    'post_cust_hit_time_gmt': 'datetime64[ns, UTC]',
+    'visit_start_time_gmt': 'datetime64[ns, UTC]',
+    'referrer': 'category',
+    'Account_Created_journey': 'int8',
+    'simulated_detailed_event': 'category',
+    'simulated_subject': 'category',
+}
+DATE_COLUMNS = [name for name, dtype in COLUMNS.items() if dtype.startswith('datetime')]
+# Integer columns the export may leave blank: read as nullable integers,
+# then the blanks are filled with 0 ("no account created")
+BLANK_COLUMNS = {'Account_Created_journey': 'Int8'}
+
+# Bump when COLUMNS or the parsing below changes so stale caches are ignored
+CACHE_VERSION = 2
+CACHE_DIR = os.environ.get('RC_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+
+
+def fingerprint(path):
+    # Identify a source file by its location, size and modification time so
+    # that the cache is rebuilt as soon as the export is replaced
+    stat = os.stat(path)
+    key = '|'.join([
+        os.path.abspath(path),
+        str(stat.st_size),
+        str(stat.st_mtime_ns),
+        str(CACHE_VERSION),
+        ','.join(COLUMNS),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_timestamps(values):
+    # The export writes GMT times as "2022-05-20T22:01:19.000Z", which numpy
+    # parses directly once the "Z" is dropped, several times faster than
+    # read_csv's parse_dates. Other formats go through pandas.
+    try:
+        parsed = values.str.rstrip('Z').fillna('NaT').to_numpy(dtype='datetime64[ns]')
+    except ValueError:
+        return pd.to_datetime(values, utc=True, format='ISO8601')
+    return pd.Series(pd.DatetimeIndex(parsed).tz_localize('UTC'), index=values.index, name=values.name)
+
+
+# Epoch second standing for a missing timestamp
+MISSING_SECONDS = np.iinfo('int64').min
+
+
+def epoch_seconds(values):
+    # GMT timestamps as int64 seconds since the epoch
+    return pd.to_datetime(values, utc=True).to_numpy(dtype='datetime64[s]').astype('int64')
+
+
+def with_timestamps(data):
+    for name in DATE_COLUMNS:
+        data[name] = parse_timestamps(data[name])
+    return data
+
+
+def fill_blanks(data):
+    for name in BLANK_COLUMNS:
+        data[name] = data[name].fillna(0).astype(COLUMNS[name])
+    return data
+
+
+def open_csv(path, **kwargs):
+    # Parse only the chart columns with their final dtypes, dates as text
+    dtypes = {name: (object if name in DATE_COLUMNS else BLANK_COLUMNS.get(name, dtype)) for name, dtype in COLUMNS.items()}
+    return pd.read_csv(path, usecols=list(COLUMNS), dtype=dtypes, **kwargs)
+
+
+def read_csv(path):
+    return fill_blanks(with_timestamps(open_csv(path)))
+
+
+def read_parquet(path):
+    # Same columns and dtypes as read_csv, from a Parquet export
+    data = pd.read_parquet(path, columns=list(COLUMNS))
+    for name, dtype in COLUMNS.items():
+        if name in DATE_COLUMNS:
+            data[name] = pd.to_datetime(data[name], utc=True) if pd.api.types.is_datetime64_any_dtype(data[name]) else parse_timestamps(data[name])
+        else:
+            data[name] = data[name].astype(BLANK_COLUMNS.get(name, dtype))
+    return fill_blanks(data)
+
+
+def read_export(path):
+    # CSV or Parquet export, by file extension
+    if os.path.splitext(path)[1].lower() in ('.parquet', '.pq'):
+        return read_parquet(path)
+    return read_csv(path)
+
+
+def iter_chunks(path, chunksize):
+    # Stream the export in bounded, already typed chunks
+    with open_csv(path, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield fill_blanks(with_timestamps(chunk))
+
+
+def cache_path(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, '{}-{}.arrow'.format(stem, fingerprint(path)))
+
+
+def prune_cache(path):
+    # Remove the cache files and visit indexes of older versions of the
+    # export, which are keyed by the same stem and another fingerprint
+    stem = os.path.splitext(os.path.basename(path))[0]
+    pattern = re.compile(r'{}-([0-9a-f]{{16}})(\.arrow|-visits-\d+)$'.format(re.escape(stem)))
+    current = fingerprint(path)
+    for name in os.listdir(CACHE_DIR) if os.path.isdir(CACHE_DIR) else []:
+        match = pattern.match(name)
+        if match and match.group(1) != current:
+            stale = os.path.join(CACHE_DIR, name)
+            if os.path.isdir(stale):
+                shutil.rmtree(stale, ignore_errors=True)
+            else:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+
+def load_data(path, use_cache=True):
+    if not use_cache:
+        with instrument.span('load.export') as span:
+            data = read_export(path)
+            span.set_rows_out(data)
+        return data
+
+    cached = cache_path(path)
+    if os.path.exists(cached):
+        # The Arrow IPC file is memory-mapped and read straight from the page
+        # cache, but to_pandas still gives each process its own copy
+        with instrument.span('load.cache') as span:
+            table = feather.read_table(cached, memory_map=True)
+            data = table.to_pandas()
+            span.set_rows_out(data)
+    else:
+        with instrument.span('load.export') as span:
+            data = read_export(path)
+            span.set_rows_out(data)
+        with instrument.span('load.write_cache', data):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a temporary name first so that concurrent workers never
+            # read a partially written cache file
+            tmp = '{}.{}.{}.tmp'.format(cached, os.getpid(), threading.get_ident())
+            data.to_feather(tmp, compression='uncompressed')
+            os.replace(tmp, cached)
+            prune_cache(path)
+    return data
@@ -1,48 +1,149 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
 import networkx as nx
 from pyvis.network import Network
-from IPython.display import display, HTML
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
 
-def generate_network(data):
-    # Replace NaN values with "Home"
-    data = data.fillna("Home")
+import aggregate
+import instrument
+import transitions
 
-    # Extract information about visited pages
-    visited_pages = data[['simulated_detailed_event', 'simulated_subject']].drop_duplicates()
+# Edges kept for each page, and the fewest visits a route needs to be drawn
+TOP_K = 5
+MIN_COUNT = 2
 
-    # Extract visits that led to account creation
-    account_creation_visits = data[data['Account_Created_journey'] == 1]
+# Most nodes drawn: past it, the quietest pages are merged into one node per
+# section so the page stays responsive whatever the size of the graph
+MAX_NODES = 60
+OTHER = 'Other pages'
 
-    # Create a network graph
-    G = nx.DiGraph()
+# Template directory holding the network page and its legend
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Rendered pages keyed by a fingerprint of the drawn edges, the most
+# recently used HTML_CACHE_SIZE kept, like the filtered summaries
+HTML_CACHE_SIZE = 64
+_html_cache = OrderedDict()
+_html_cache_lock = threading.Lock()
+
+
+def clusters(edges, event_subjects):
+    # Section each page is merged into: the one most of its visits belong to
+    traffic = event_subjects[event_subjects > 0].reset_index(name='count')
+    traffic = traffic.sort_values(['count', 'simulated_subject'], ascending=[False, True])
+    subjects = traffic.drop_duplicates('target').set_index('target')['simulated_subject']
+    nodes = pd.unique(edges[['source', 'target']].values.ravel())
+    subjects = pd.Series(subjects.reindex(nodes).to_numpy(), index=nodes)
+    return ('Other ' + subjects + ' pages').fillna(OTHER)
+
+
+def collapse(edges, event_subjects, max_nodes):
+    # Keep the busiest pages and route the others through their section's
+    # cluster node, keeping room for one cluster per section. When the
+    # budget cannot fit them, every other page goes to one OTHER node.
+    # Returns the edges and the names of the cluster nodes.
+    if max_nodes < 2:
+        raise ValueError('the network needs at least 2 nodes, got {}'.format(max_nodes))
+    counts = pd.concat([
+        edges.groupby('source')['count'].sum(),
+        edges.groupby('target')['count'].sum(),
+    ]).groupby(level=0).sum()
+    # Account Creation is always drawn
+    if len(counts.index.union([transitions.ACCOUNT_CREATION])) <= max_nodes:
+        return edges, set()
+    names = clusters(edges, event_subjects)
+    pages = max_nodes - 1 - names.nunique()
+    if pages < 1:
+        names[:] = OTHER
+        pages = max_nodes - 2
+    counts = counts.drop(transitions.ACCOUNT_CREATION, errors='ignore')
+    ranked = counts.sort_values(ascending=False, kind='stable').index
+    kept = ranked[:pages].append(pd.Index([transitions.ACCOUNT_CREATION]))
+    collapsed = ~names.index.isin(kept)
+    names = names.where(collapsed, names.index.to_series())
+
+    merged = pd.DataFrame({
+        'source': names[edges['source']].to_numpy(),
+        'target': names[edges['target']].to_numpy(),
+        'count': edges['count'].to_numpy(),
+    })
+    # Routes between pages merged into the same cluster are not drawn
+    cluster_nodes = set(names[collapsed])
+    merged = merged[(merged['source'] != merged['target']) | ~merged['source'].isin(cluster_nodes)]
+    return merged.groupby(['source', 'target'], as_index=False)['count'].sum(), cluster_nodes
 
-    # Add nodes for visited pages
-    for _, row in visited_pages.iterrows():
-        G.add_node(row['simulated_detailed_event'], node_type='page')
-        G.add_node(row['simulated_subject'], node_type='subject')
-        G.add_edge(row['simulated_subject'], row['simulated_detailed_event'], edge_type='visit')
 
-    # Add the "Account Creation" node and connect all links leading to it
-    G.add_node('Account Creation', node_type='account_creation')
-    for _, row in account_creation_visits.iterrows():
-        G.add_edge(row['simulated_detailed_event'], 'Account Creation', edge_type='account_creation')
+def layout(G, iterations=50):
+    # Node positions computed here once rather than by the browser's physics
+    # simulation: a vectorized Fruchterman-Reingold layout, seeded so the
+    # same graph is always drawn the same way
+    nodes = list(G)
+    if not nodes:
+        return {}
+    adjacency = nx.to_numpy_array(G, nodelist=nodes, weight=None)
+    adjacency = np.maximum(adjacency, adjacency.T)
+    positions = np.random.default_rng(0).random((len(nodes), 2))
+    k = 1 / np.sqrt(len(nodes))
+    temperature = 0.1
+    for _ in range(iterations):
+        delta = positions[:, None, :] - positions[None, :, :]
+        distance = np.maximum(np.linalg.norm(delta, axis=-1), 0.01)
+        # Every pair repels, linked pairs attract
+        force = k * k / distance ** 2 - adjacency * distance / k
+        displacement = np.einsum('ijk,ij->ik', delta, force)
+        length = np.maximum(np.linalg.norm(displacement, axis=-1), 0.01)
+        positions += displacement * (temperature / length)[:, None]
+        temperature -= 0.1 / (iterations + 1)
+
+    # Centre the drawing and size it for the number of nodes
+    positions -= positions.mean(axis=0)
+    positions *= max(300, 80 * np.sqrt(len(nodes))) / max(np.abs(positions).max(), 1e-9)
+    return {node: (float(x), float(y)) for node, (x, y) in zip(nodes, positions)}
+
+
+def generate_network(data, top_k=TOP_K, min_count=MIN_COUNT, max_nodes=MAX_NODES):
+    # Most frequent page-to-page transitions
+    with instrument.span('network.aggregate', data) as span:
+        summary = aggregate.as_summary(data)
+        edges = transitions.top_edges(summary['transitions'], top_k, min_count)
+        edges, cluster_nodes = collapse(edges, summary['event_subjects'], max_nodes)
+        span.set_rows_out(edges)
+
+    # The page only depends on the drawn edges, so reuse it when they match
+    key = hashlib.sha1(pd.util.hash_pandas_object(edges, index=False).values.tobytes()).hexdigest()
+    with _html_cache_lock:
+        if key in _html_cache:
+            _html_cache.move_to_end(key)
+            return _html_cache[key]
+
+    # Create a network graph weighted by the number of visits on each route
+    G = nx.DiGraph()
+    G.add_node(transitions.ACCOUNT_CREATION, node_type='account_creation')
+    for node in pd.unique(edges[['source', 'target']].values.ravel()):
+        if node != transitions.ACCOUNT_CREATION:
+            G.add_node(node, node_type='cluster' if node in cluster_nodes else 'page')
+    G.add_weighted_edges_from(edges[['source', 'target', 'count']].itertuples(index=False, name=None))
+    with instrument.span('network.layout', len(G)):
+        positions = layout(G)
 
     # Create PyVis network
-    nt = Network(height='800px', width='100%', notebook=True)
+    nt = Network(height='800px', width='100%')
+    nt.set_template_dir(TEMPLATE_DIR, 'network.html')
 
     # Add nodes with their attributes
     for node, node_type in G.nodes(data='node_type'):
-        color = 'green' if node_type == 'account_creation' else 'lightblue'
-        nt.add_node(node, label=node, color=color, shape='dot')
+        color = {'account_creation': 'green', 'cluster': 'lightgray'}.get(node_type, 'lightblue')
+        x, y = positions[node]
+        nt.add_node(node, label=node, color=color, shape='dot', x=x, y=y, physics=False)
 
-    # Add edges with their attributes
-    for u, v, edge_type in G.edges(data='edge_type'):
-        color = 'green' if edge_type == 'account_creation' else 'gray'
-        width = 4 if edge_type == 'account_creation' else 1
-        nt.add_edge(u, v, color=color, width=width)
+    # Add edges with their attributes, wider for busier routes
+    for u, v, weight in G.edges(data='weight'):
+        color = 'green' if v == transitions.ACCOUNT_CREATION else 'gray'
+        nt.add_edge(u, v, color=color, value=int(weight), title='Route taken {} times'.format(weight))
 
     # Set options for the network visualization
     nt.set_options("""
@@ -59,67 +160,22 @@ def generate_network(data):
         "font": {
         "size": 10,
         "color": "gray"
+        },
+        "smooth": {
+        "type": "continuous"
         }
     },
     "physics": {
-        "stabilization": true,
-        "forceAtlas2Based": {
-        "gravitationalConstant": -50,
-        "centralGravity": 0.01,
-        "springLength": 200,
-        "springConstant": 0.08
-        },
-        "minVelocity": 0.75
+        "enabled": false
     }
     }
     """)
 
-    # Add legend
-    legend_html = '''
-    <div class="legend" style="position: absolute; top: 10px; right: 10px; background-color: white; border: 1px solid #ccc; padding: 10px; font-family: Arial, sans-serif;">
-        <h6>Legend</h6>
-        <hr>
-        
-        <div>
-            <svg height="15" width="15">
-                <circle cx="8" cy="8" r="6" fill="lightblue" />
-            </svg>
-            Node section and action on the website
-        </div>
-        <div>
-            <svg height="15" width="15">
-                <circle cx="8" cy="8" r="6" fill="green" />
-            </svg>
-            Account Creation Node
-        </div>
-        <div>
-            <svg height="10" width="100">
-                <line x1="0" y1="8" x2="20" y2="8" style="stroke:gray;stroke-width:1" />
-            </svg>
-            Node Link
-        </div>
-        <div>
-            <svg height="10" width="60">
-                <line x1="0" y1="8" x2="20" y2="8" style="stroke:green;stroke-width:1" />
-            </svg>
-            Link to Account Creation
-        </div>
-        <div>
-            <svg height="10" width="60">
-                <line x1="0" y1="8" x2="20" y2="8" style="stroke:green;stroke-width:4" />
-            </svg>
-            Multiple Connections
-        </div>
-    </div>
-    '''
-
-    # Save the network visualization as HTML
-    nt.save_graph('net.html')
-
-    # Read the HTML file
-    with open('net.html', 'r') as file:
-        content = file.read()
-
-    # Insert the legend HTML code into the content
-    content = content.replace('</body>', legend_html + '</body>')
+    # Render the page in memory from the template, which also holds the legend
+    with instrument.span('network.render', edges):
+        content = nt.generate_html(notebook=False)
+    with _html_cache_lock:
+        _html_cache[key] = content
+        while len(_html_cache) > HTML_CACHE_SIZE:
+            _html_cache.popitem(last=False)
     return content
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+import visits
+
+
+def count_prefixes(data, max_depth, groups=None, index=None):
+    # Count the account-creating visits going through every path prefix of
+    # up to max_depth events. The result is indexed by the group code of the
+    # visit (its first hit's entry in groups) and the "event/event/..." id.
+    if index is None:
+        index = visits.build_index(data)
+    vocabulary = index['vocabulary']
+    hit_visits = visits.hit_visits(index)
+    position = visits.positions(index)
+    keep = index['creating'][hit_visits] & (position < max_depth)
+    position = position[keep]
+    events = index['events'][keep]
+    hit_groups = visits.visit_groups(index, groups)[hit_visits[keep]]
+
+    # Hits of one visit are consecutive, so the parent of a hit at level n
+    # is the node of the hit just before it
+    node = np.empty(len(events), dtype='int64')
+    ids = []
+    offset = 0
+    by_level = np.argsort(position, kind='stable')
+    bounds = np.searchsorted(position[by_level], np.arange(max_depth + 1))
+    for level in range(max_depth):
+        at = by_level[bounds[level]:bounds[level + 1]]
+        if len(at) == 0:
+            break
+        parent = node[at - 1] if level else np.full(len(at), -1)
+        keys, inverse = np.unique((parent + 1) * len(vocabulary) + events[at], return_inverse=True)
+        node[at] = offset + inverse
+
+        labels = vocabulary[keys % len(vocabulary)]
+        if level:
+            parent_ids = np.concatenate(ids)[keys // len(vocabulary) - 1]
+            labels = parent_ids + '/' + labels
+        ids.append(labels)
+        offset += len(keys)
+
+    # Count the visits of each group going through each node
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=object)
+    nodes = max(offset, 1)
+    pairs, counts = np.unique(hit_groups * nodes + node, return_counts=True)
+    counts_index = pd.MultiIndex.from_arrays([pairs // nodes, ids[pairs % nodes]], names=['group', 'path'])
+    return pd.Series(counts, index=counts_index, dtype='int64').sort_index()
+
+
+def split_ids(ids):
+    # Parent id and label of each "event/event/..." id
+    if len(ids) == 0:
+        return np.zeros(0, dtype=object), np.zeros(0, dtype=object)
+    parts = pd.Series(ids, dtype=object).str.rpartition('/')
+    return parts[0].to_numpy(), parts[2].to_numpy()
@@ -1,19 +1,27 @@
-import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import plotly.express as px
 
-def generate_polar(my_df):
-    
-    keep = ['identifiant_visite', 'visit_page_num', 'visit_start_time_gmt', 'Account_Created_journey']
-    my_df = my_df[keep]
-    my_df = my_df[my_df['visit_page_num'] == 1]
-    my_df['visit_start_time_gmt'] = pd.to_datetime(my_df['visit_start_time_gmt'])
-    my_df['hour'] = my_df['visit_start_time_gmt'].dt.hour
-    my_df = my_df.drop('visit_start_time_gmt', axis=1)
-    hour_counts = my_df['hour'].value_counts().sort_index()
-    acc_creation_ratio = my_df.groupby('hour')['Account_Created_journey'].sum().sort_index()
-    hour_ratio = acc_creation_ratio / hour_counts
+import aggregate
+import instrument
+
+# Canadian audiences are shown in Eastern time unless another zone is picked
+TIMEZONE = 'America/Toronto'
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def generate_polar(my_df, timezone=TIMEZONE, weekday=None):
+
+    # Visits and account creations per local start hour, on one weekday
+    # (0 is Monday) or on all of them
+    with instrument.span('polar.aggregate', my_df) as span:
+        hours = aggregate.as_summary(my_df)['hours']
+        shown = hours.index.get_level_values('timezone') == timezone
+        if weekday is not None:
+            shown &= hours.index.get_level_values('weekday') == weekday
+        hours = hours[shown].groupby(level='hour').sum()
+        span.set_rows_out(hours)
+    hour_counts = hours['visits']
+    acc_creation_ratio = hours['conversions']
     theta = [360 * i / 24 for i in hour_counts.index]
 
     # Define the color scale using Python Plotly "Blues" color scale
@@ -51,12 +59,12 @@ def generate_polar(my_df):
         marker=dict(
             color=[acc_creation_ratio.values],
             colorscale=color_scale,
-            cmax=max(acc_creation_ratio.values),
-            cmin=min(acc_creation_ratio.values),
+            cmax=max(acc_creation_ratio.values, default=0),
+            cmin=min(acc_creation_ratio.values, default=0),
             showscale=True,
             colorbar=dict(
                 title='Number of Visits',
-                tickvals=[min(acc_creation_ratio.values), max(acc_creation_ratio.values)],
+                tickvals=[min(acc_creation_ratio.values, default=0), max(acc_creation_ratio.values, default=0)],
                 ticktext=['Min', 'Max'],
                 titleside='top',
                 lenmode='fraction',
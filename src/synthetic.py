@@ -0,0 +1,151 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Schema of the Radio-Canada clickstream export (see RC1000-1.csv)
+COLUMNS = [
+    'identifiant_visite', 'visit_num', 'visit_page_num', 'post_cust_hit_time_gmt', 'visit_start_time_gmt',
+    'referrer', 'encrypted_user_id', 'Account_Created_journey', 'simulated_detailed_event',
+    'Action_description', 'simulated_subject',
+]
+
+# Shares observed in the sample export
+REFERRERS = ['Search Engines', 'Typed/Bookmarked', 'Social Networks', 'Other Web Sites', 'No JavaScript', None]
+REFERRER_SHARES = [0.366, 0.338, 0.244, 0.039, 0.003, 0.010]
+SUBJECTS = ['sports', 'histoire', 'cuisine', 'politique', 'economie', 'science', 'environnement']
+BRANDS = ['Mordu', 'Info', 'OHdio']
+BRAND_SHARES = [0.75, 0.18, 0.07]
+# Page kinds of each brand; home pages carry no subject
+PAGE_KINDS = ['Page_accueil_{}', 'Page_{}', 'Video_{}']
+PAGE_KIND_SHARES = [0.2, 0.35, 0.45]
+OTHER_ACTIONS = ['authentification', 'feature_ohdio']
+
+# Visit shape: most visits are a single page, the rest have a long tail
+SINGLE_PAGE_SHARE = 0.64
+MEAN_EXTRA_PAGES = 8
+MAX_PAGES = 250
+# Chance that a page is the same event as the previous one
+REPEAT_SHARE = 0.6
+OTHER_ACTION_SHARE = 0.005
+# Share of visits that create an account
+CONVERSION_SHARE = 0.03
+MEAN_SECONDS_BETWEEN_HITS = 45
+START = pd.Timestamp('2022-05-01')
+DAYS = 48
+# Relative traffic for each GMT hour
+HOUR_WEIGHTS = np.array([5, 4, 3, 2, 2, 2, 3, 5, 7, 9, 10, 11, 12, 12, 12, 12, 12, 13, 14, 14, 13, 11, 9, 7], dtype=float)
+
+
+def visit_lengths(rng, n_hits):
+    # Draw visit lengths until they cover n_hits, then trim the last visit
+    lengths = []
+    total = 0
+    while total < n_hits:
+        batch = max(1024, (n_hits - total) // 3)
+        extra = np.minimum(rng.geometric(1 / MEAN_EXTRA_PAGES, batch), MAX_PAGES - 1)
+        drawn = np.where(rng.random(batch) < SINGLE_PAGE_SHARE, 1, 1 + extra)
+        lengths.append(drawn)
+        total += drawn.sum()
+    lengths = np.concatenate(lengths)
+    cut = np.searchsorted(np.cumsum(lengths), n_hits)
+    lengths = lengths[:cut + 1]
+    lengths[-1] -= lengths.sum() - n_hits
+    return lengths
+
+
+def hex_ids(rng, count):
+    # 32-character hexadecimal ids like the export's hashed user ids
+    high = rng.integers(0, 2 ** 63, count, dtype=np.int64)
+    low = rng.integers(0, 2 ** 63, count, dtype=np.int64)
+    return np.char.add(np.char.mod('%016x', high), np.char.mod('%016x', low))
+
+
+def iso_times(seconds):
+    # GMT timestamps formatted like "2022-05-20T22:01:19.000Z"
+    text = seconds.astype('datetime64[s]').astype(str)
+    return np.char.add(text, '.000Z')
+
+
+def generate_clickstream(n_hits, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = visit_lengths(rng, n_hits)
+    n_visits = len(lengths)
+
+    # Users come back for several visits, numbered per user
+    n_users = max(1, int(n_visits * 0.8))
+    users = rng.integers(0, n_users, n_visits)
+    user_ids = hex_ids(rng, n_users)
+    first_visit = rng.integers(1, 500, n_users)
+    visit_num = first_visit[users] + pd.Series(users).groupby(users).cumcount().to_numpy()
+    order = np.lexsort((visit_num, users))
+    users = users[order]
+    visit_num = visit_num[order]
+    lengths = lengths[order]
+
+    # Visit-level attributes
+    day = rng.integers(0, DAYS, n_visits)
+    hour = rng.choice(24, n_visits, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    start = START.value // 10 ** 9 + day * 86400 + hour * 3600 + rng.integers(0, 3600, n_visits)
+    referrer = np.array(REFERRERS, dtype=object)[rng.choice(len(REFERRERS), n_visits, p=REFERRER_SHARES)]
+    brand = rng.choice(len(BRANDS), n_visits, p=BRAND_SHARES)
+    # Only multi-page visits can end on the account creation action
+    converting = (rng.random(n_visits) < CONVERSION_SHARE / (1 - SINGLE_PAGE_SHARE)) & (lengths > 1)
+
+    # Hit-level attributes
+    visit = np.repeat(np.arange(n_visits), lengths)
+    visit_start = np.r_[0, np.cumsum(lengths)[:-1]]
+    page = np.arange(n_hits) - np.repeat(visit_start, lengths) + 1
+    last_page = page == lengths[visit]
+    gaps = np.where(page == 1, 0, rng.exponential(MEAN_SECONDS_BETWEEN_HITS, n_hits).astype(np.int64))
+    hit_time = start[visit] + pd.Series(gaps).groupby(visit).cumsum().to_numpy()
+
+    # Events repeat the previous page's event with REPEAT_SHARE, which gives
+    # the long same-event runs seen in the export
+    kind = pd.Series(rng.choice(len(PAGE_KINDS), n_hits, p=PAGE_KIND_SHARES))
+    kind[(rng.random(n_hits) < REPEAT_SHARE) & (page > 1)] = None
+    kind = kind.ffill().to_numpy(dtype=np.int64)
+    names = np.array([k.format(b) for k in PAGE_KINDS for b in BRANDS], dtype=object)
+    event = pd.Series(names[kind * len(BRANDS) + brand[visit]])
+    subject = pd.Series(np.array(SUBJECTS, dtype=object)[rng.integers(0, len(SUBJECTS), n_hits)])
+    subject[kind == 0] = None
+
+    description = pd.Series(None, index=event.index, dtype=object)
+    other = (rng.random(n_hits) < OTHER_ACTION_SHARE) & ~last_page
+    event[other] = 'Action_autre'
+    subject[other] = None
+    description[other] = np.array(OTHER_ACTIONS, dtype=object)[rng.integers(0, len(OTHER_ACTIONS), other.sum())]
+
+    # Account-creating visits end on the account creation action
+    created = converting[visit] & last_page
+    event[created] = 'Action_creation_compte'
+    subject[created] = None
+    description[created] = 'entete|creer-mon-compte'
+
+    visit_ids = np.char.add(np.char.add(user_ids[users], '-'), visit_num.astype(str))
+    return pd.DataFrame({
+        'identifiant_visite': visit_ids[visit],
+        'visit_num': visit_num[visit],
+        'visit_page_num': page,
+        'post_cust_hit_time_gmt': iso_times(hit_time),
+        'visit_start_time_gmt': iso_times(start)[visit],
+        'referrer': referrer[visit],
+        'encrypted_user_id': user_ids[users][visit],
+        'Account_Created_journey': converting[visit].astype(np.int8),
+        'simulated_detailed_event': event.to_numpy(),
+        'Action_description': description.to_numpy(),
+        'simulated_subject': subject.to_numpy(),
+    }, columns=COLUMNS)
+
+
+def write_clickstream(path, n_hits, seed=0):
+    generate_clickstream(n_hits, seed).to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic clickstream export')
+    parser.add_argument('path')
+    parser.add_argument('hits', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_clickstream(args.path, args.hits, args.seed)
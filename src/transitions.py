@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+import visits
+
+# Terminal node reached by visits that created an account
+ACCOUNT_CREATION = 'Account Creation'
+
+
+def count_transitions(data, groups=None, index=None):
+    # Count page-to-page transitions inside visits, as a Series indexed by
+    # the group code of the visit (its first hit's entry in groups) and the
+    # (source, target) events. Account-creating visits also contribute one
+    # transition from their last event to ACCOUNT_CREATION.
+    if index is None:
+        index = visits.build_index(data)
+    events = index['events']
+    vocabulary = np.append(index['vocabulary'], ACCOUNT_CREATION)
+    terminal = len(vocabulary) - 1
+    hit_visits = visits.hit_visits(index)
+
+    # Every hit but the last of its visit starts a transition
+    same_visit = np.ones(len(events), dtype=bool)
+    same_visit[index['offsets'][1:] - 1] = False
+    same_visit = same_visit[:-1]
+    created = np.flatnonzero(index['creating'])
+    last_hits = index['offsets'][created + 1] - 1
+    sources = np.concatenate([events[:-1][same_visit], events[last_hits]])
+    targets = np.concatenate([events[1:][same_visit], np.full(len(created), terminal)])
+    hit_groups = visits.visit_groups(index, groups)[np.concatenate([hit_visits[:-1][same_visit], created])]
+
+    size = len(vocabulary)
+    keys, counts = np.unique((hit_groups * size + sources) * size + targets, return_counts=True)
+    counts_index = pd.MultiIndex.from_arrays(
+        [keys // (size * size), vocabulary[keys // size % size], vocabulary[keys % size]],
+        names=['group', 'source', 'target']
+    )
+    return pd.Series(counts, index=counts_index, dtype='int64').sort_index()
+
+
+def top_edges(transitions, top_k, min_count):
+    # Keep transitions seen at least min_count times and, for each source,
+    # only its top_k most frequent targets
+    edges = transitions[transitions >= min_count].reset_index(name='count')
+    edges = edges.sort_values(['source', 'count', 'target'], ascending=[True, False, True])
+    edges = edges[edges.groupby('source').cumcount() < top_k]
+    return edges.reset_index(drop=True)
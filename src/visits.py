@@ -0,0 +1,240 @@
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+import encoding
+import loader
+
+# Label of the hits without an event
+HOME = 'Home'
+
+# Arrays of a visit index. The vocabulary is stored as fixed-width text so
+# that it can be memory-mapped like the others.
+ARRAYS = ['order', 'offsets', 'events', 'times', 'creating', 'vocabulary']
+# Arrays the funnel reads, saved with the index so every process maps them
+# instead of computing its own copy
+EVENT_ARRAYS = ['hit_visits', 'by_event', 'bounds']
+# Bump when ARRAYS or their meaning change so saved indexes are rebuilt
+INDEX_VERSION = 3
+
+# Hits handled at a time when an index is written chunk by chunk
+BLOCK = 1 << 22
+# Room reserved for the header of a .npy file written before its length is
+# known; a one-dimensional shape always fits
+NPY_HEADER = 128
+
+
+def build_index(data):
+    # Hits sorted by visit and page number: order[i] is the row of the i-th
+    # hit, and offsets[v]:offsets[v + 1] are the hits of visit v. events and
+    # times hold the event code and GMT epoch second of each hit in that
+    # order, and creating tells whether each visit created an account.
+    visit_codes = encoding.encode(data['identifiant_visite'])[0]
+    order = np.lexsort((data['visit_page_num'].to_numpy(), visit_codes))
+    sorted_visits = visit_codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_visits[1:] != sorted_visits[:-1]]) if len(order) else np.zeros(0, dtype='int64')
+
+    events, vocabulary = encoding.encode(data['simulated_detailed_event'], HOME)
+    times = loader.epoch_seconds(data['post_cust_hit_time_gmt'])
+    journey = pd.to_numeric(data['Account_Created_journey'], errors='coerce').fillna(0).to_numpy()[order] != 0
+    creating = np.logical_or.reduceat(journey, starts) if len(starts) else np.zeros(0, dtype=bool)
+
+    return {
+        'order': order,
+        'offsets': np.r_[starts, len(order)],
+        'events': events[order],
+        'times': times[order],
+        'creating': creating,
+        'vocabulary': vocabulary,
+    }
+
+
+def whole_visits(chunks):
+    # Regroup chunks of an export so no visit is split between two of them.
+    # Exports are grouped by visit, so the last visit of a chunk is held
+    # back and prepended to the next one to keep its pages together.
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = encoding.concat([carry, chunk])
+        tail = chunk['identifiant_visite'] == chunk['identifiant_visite'].iloc[-1]
+        carry = chunk[tail]
+        if not tail.all():
+            yield chunk[~tail]
+    if carry is not None:
+        yield carry
+
+
+def lengths(index):
+    return np.diff(index['offsets'])
+
+
+def hit_visits(index):
+    # Visit number of every hit, in index order
+    return np.repeat(np.arange(len(index['creating'])), lengths(index))
+
+
+def positions(index):
+    # Position of every hit inside its visit, in index order
+    return np.arange(len(index['order'])) - np.repeat(index['offsets'][:-1], lengths(index))
+
+
+def first_hits(index):
+    # Row of the first hit of each visit
+    return index['order'][index['offsets'][:-1]]
+
+
+def visit_groups(index, groups):
+    # Group code of each visit, taken from its first hit
+    if groups is None:
+        return np.zeros(len(index['creating']), dtype='int64')
+    return np.asarray(groups)[first_hits(index)]
+
+
+def event_order(index):
+    # Visit number of every hit, and the hits grouped by event code in index
+    # order within each event: bounds[e]:bounds[e + 1] of by_event are the
+    # hits of event e
+    by_event = np.argsort(index['events'], kind='stable')
+    return {
+        'hit_visits': hit_visits(index),
+        'by_event': by_event,
+        'bounds': np.searchsorted(index['events'][by_event], np.arange(len(index['vocabulary']) + 1)),
+    }
+
+
+def publish(tmp, directory):
+    # Move a finished index into place. An index saved meanwhile by another
+    # process or thread is the same, so it is kept and this one dropped.
+    try:
+        os.replace(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(directory):
+            raise
+
+
+def temporary_directory(directory):
+    tmp = '{}.{}.{}.tmp'.format(directory, os.getpid(), threading.get_ident())
+    os.makedirs(tmp, exist_ok=True)
+    return tmp
+
+
+def save_index(index, directory):
+    # One .npy file per array, written to a temporary directory first so
+    # readers never see a partial index
+    tmp = temporary_directory(directory)
+    index = dict(index, **event_order(index))
+    for name in ARRAYS + EVENT_ARRAYS:
+        array = index[name].astype(str) if name == 'vocabulary' else index[name]
+        np.save(os.path.join(tmp, name + '.npy'), array)
+    publish(tmp, directory)
+
+
+def npy_header(dtype, length):
+    # Version 1.0 .npy header of a one-dimensional array, padded to
+    # NPY_HEADER bytes
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(np.dtype(dtype).str, length)
+    header = header.ljust(NPY_HEADER - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+
+def open_index(directory):
+    # Start an index written one part of the export at a time, so it never
+    # has to be held in memory: each array is appended to its .npy file as
+    # the parts come, and the header is written once the length is known
+    tmp = temporary_directory(directory)
+    writer = {'directory': directory, 'tmp': tmp, 'labels': {}, 'hits': 0, 'visits': 0, 'files': {}}
+    for name in ['order', 'offsets', 'events', 'times', 'creating', 'hit_visits']:
+        file = open(os.path.join(tmp, name + '.npy'), 'w+b')
+        file.write(bytes(NPY_HEADER))
+        writer['files'][name] = file
+    return writer
+
+
+def append_index(writer, index):
+    # Add the index of the next part, whose rows follow the previous parts'
+    labels = writer['labels']
+    codes = np.array([labels.setdefault(label, len(labels)) for label in index['vocabulary']], dtype='int64')
+    files = writer['files']
+    np.asarray(index['order'] + writer['hits'], dtype='int64').tofile(files['order'])
+    np.asarray(index['offsets'][:-1] + writer['hits'], dtype='int64').tofile(files['offsets'])
+    np.asarray(codes[index['events']] if len(codes) else index['events'], dtype='int64').tofile(files['events'])
+    np.asarray(index['times'], dtype='int64').tofile(files['times'])
+    np.asarray(index['creating'], dtype=bool).tofile(files['creating'])
+    np.asarray(hit_visits(index) + writer['visits'], dtype='int64').tofile(files['hit_visits'])
+    writer['hits'] += len(index['order'])
+    writer['visits'] += len(index['creating'])
+
+
+def close_index(writer):
+    # Finish the headers, then sort the hits by event block by block into
+    # by_event, and move the index into place
+    tmp, hits = writer['tmp'], writer['hits']
+    files = writer['files']
+    np.asarray([hits], dtype='int64').tofile(files['offsets'])
+    for name, file in files.items():
+        length = writer['visits'] + 1 if name == 'offsets' else writer['visits'] if name == 'creating' else hits
+        file.seek(0)
+        file.write(npy_header(bool if name == 'creating' else 'int64', length))
+        file.close()
+
+    vocabulary = np.array(list(writer['labels']), dtype=object)
+    np.save(os.path.join(tmp, 'vocabulary.npy'), vocabulary.astype(str))
+    events = np.load(os.path.join(tmp, 'events.npy'), mmap_mode='r')
+    counts = np.zeros(len(vocabulary), dtype='int64')
+    for start in range(0, hits, BLOCK):
+        counts += np.bincount(events[start:start + BLOCK], minlength=len(vocabulary))
+    bounds = np.r_[0, np.cumsum(counts)]
+    np.save(os.path.join(tmp, 'bounds.npy'), bounds)
+
+    # Counting sort: each block's hits go after those of the same event in
+    # the blocks before it
+    by_event = np.lib.format.open_memmap(os.path.join(tmp, 'by_event.npy'), mode='w+', dtype='int64', shape=(hits,))
+    cursor = bounds[:-1].copy()
+    for start in range(0, hits, BLOCK):
+        block = np.asarray(events[start:start + BLOCK])
+        order = np.argsort(block, kind='stable')
+        sorted_events = block[order]
+        block_counts = np.bincount(block, minlength=len(vocabulary))
+        rank = np.arange(len(block)) - np.repeat(np.r_[0, np.cumsum(block_counts)[:-1]], block_counts)
+        by_event[cursor[sorted_events] + rank] = order + start
+        cursor += block_counts
+    by_event.flush()
+    del by_event, events
+    publish(tmp, writer['directory'])
+
+
+def load_index(directory):
+    # The arrays are memory-mapped, so processes reading the same index
+    # share one copy in the page cache
+    index = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ARRAYS + EVENT_ARRAYS}
+    index['vocabulary'] = index['vocabulary'].astype(object)
+    return index
+
+
+def index_directory(path):
+    # Saved index of an export, next to its Arrow cache
+    return '{}-visits-{}'.format(os.path.splitext(loader.cache_path(path))[0], INDEX_VERSION)
+
+
+def cached_index(path, data=None, chunksize=0):
+    # Index of an export, saved once built. Without data the export is
+    # loaded whole, or streamed chunksize rows at a time when given.
+    directory = index_directory(path)
+    if os.path.exists(directory):
+        return load_index(directory)
+    os.makedirs(loader.CACHE_DIR, exist_ok=True)
+    if data is None and chunksize:
+        writer = open_index(directory)
+        for part in whole_visits(loader.iter_chunks(path, chunksize)):
+            append_index(writer, build_index(part))
+        close_index(writer)
+    else:
+        save_index(build_index(loader.load_data(path) if data is None else data), directory)
+    loader.prune_cache(path)
+    # Read back the saved copy, which may be another writer's
+    return load_index(directory)